@@ -71,17 +71,15 @@ def do_print(args):
                 (adjusted_image.width, adjusted_image.height, required_height), file=sys.stderr)
             return 1
 
-        image = select_raster_channel(adjusted_image)
-
         # Margin check
         margin = args.margin
-        if (image.width + margin) < MINIMUM_TAPE_POINTS:
+        if (adjusted_image.width + margin) < MINIMUM_TAPE_POINTS:
             print("Image (%i) + cut margin (%i) is smaller than minimum tape width (%i) ...\n"
-                "cutting length will be extended" % (image.width, margin, MINIMUM_TAPE_POINTS))
-            margin = MINIMUM_TAPE_POINTS - image.width
+                "cutting length will be extended" % (adjusted_image.width, margin, MINIMUM_TAPE_POINTS))
+            margin = MINIMUM_TAPE_POINTS - adjusted_image.width
 
         # Raster image
-        data = raster_image(image, found_printer.media_width)
+        data = raster_and_pack(adjusted_image, found_printer.media_width)
         rasters.append({'data': data, 'margin': margin})
 
     # Print images
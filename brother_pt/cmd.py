@@ -19,10 +19,14 @@ from enum import IntEnum, IntFlag
 PRINT_HEAD_PINS = 128
 USBID_BROTHER = 0x04f9
 LINE_LENGTH_BYTES = 0x10
+EMPTY_LINE = b'\x00' * LINE_LENGTH_BYTES
 MINIMUM_TAPE_POINTS = 174 # 25.4 mm @ 180dpi
 USB_OUT_EP_ID = 0x2
 USB_IN_EP_ID = 0x81
 USB_TRX_TIMEOUT_MS = 15000
+USB_MAX_TRANSFER_BYTES = 1 << 20 # libusb splits transfers into packets
+USB_MAX_PENDING_TRANSFERS = 4
+RASTER_LINES_PER_TRANSFER = 64
 
 
 class SupportedPrinterIDs(IntEnum):
@@ -78,6 +82,17 @@ class ErrorInformation2(IntFlag):
     OVERHEATING = 0x20
 
 
+ERROR_MESSAGES = [
+    (StatusOffsets.ERROR_INFORMATION_1, ErrorInformation1.NO_MEDIA, 'no media'),
+    (StatusOffsets.ERROR_INFORMATION_1, ErrorInformation1.CUTTER_JAM, 'cutter jam'),
+    (StatusOffsets.ERROR_INFORMATION_1, ErrorInformation1.WEAK_BATTERIES, 'low batteries'),
+    (StatusOffsets.ERROR_INFORMATION_1, ErrorInformation1.HIGH_VOLTAGE_ADAPTER, 'high-voltage adapter'),
+    (StatusOffsets.ERROR_INFORMATION_2, ErrorInformation2.WRONG_MEDIA, 'wrong media (check size)'),
+    (StatusOffsets.ERROR_INFORMATION_2, ErrorInformation2.COVER_OPEN, 'cover open'),
+    (StatusOffsets.ERROR_INFORMATION_2, ErrorInformation2.OVERHEATING, 'overheating'),
+]
+
+
 class MediaType(IntEnum):
     NO_MEDIA = 0x00
     LAMINATED_TAPE = 0x01
@@ -188,9 +203,13 @@ def enable_status_notification():
 
 
 def print_information(data: bytes, media_width_mm: int):
+    return print_information_lines(len(data) // LINE_LENGTH_BYTES, media_width_mm)
+
+
+def print_information_lines(lines: int, media_width_mm: int):
     # print to arbitrary-width tape [1B 69 7A {84 00 <width> 00 <data length 4 bytes> 00 00}]
     data = b"\x1B\x69\x7A\x84\x00"+media_width_mm.to_bytes(1, 'little')+b"\x00" + \
-           (len(data) >> 4).to_bytes(4, 'little') + \
+           lines.to_bytes(4, 'little') + \
            b"\x00\x00"
     return data
 
@@ -219,20 +238,17 @@ def set_compression_mode():
 def gen_raster_commands(rasterized_image: bytes):
     raster_cmd = b'\x47'
     zero_cmd = b'\x5A'
-    cmd_buffer = []
     # send all raster data lines
     for i in range(0, len(rasterized_image), LINE_LENGTH_BYTES):
         line = rasterized_image[i:i + LINE_LENGTH_BYTES]
-        if line == b'\x00'*LINE_LENGTH_BYTES:
-            cmd_buffer.append(zero_cmd)
+        if line == EMPTY_LINE:
+            yield zero_cmd
         else:
             packed_line = packbits.encode(line)
             cmd = raster_cmd +\
                   len(packed_line).to_bytes(2, "little") +\
                   packed_line
-            cmd_buffer.append(cmd)
-
-    return cmd_buffer
+            yield cmd
 
 
 def print_without_feeding():
@@ -14,6 +14,11 @@
    limitations under the License.
 """
 import sys
+import array
+import functools
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import usb.core
 import usb.util
@@ -23,7 +28,8 @@ from .cmd import *
 from .raster import *
 
 
-def find_printers(serial=None):
+@functools.lru_cache(maxsize=None)
+def _find_printers(serial=None):
     found_printers = []
     for product_id in SupportedPrinterIDs:
         dev = usb.core.find(idVendor=USBID_BROTHER, idProduct=product_id)
@@ -36,12 +42,36 @@ def find_printers(serial=None):
             else:
                 found_printers.append(dev)
 
-    return found_printers
+    return tuple(found_printers)
+
+
+def find_printers(serial=None, cache: bool = False):
+    if not cache:
+        return list(_find_printers.__wrapped__(serial))
+
+    found_printers = _find_printers(serial)
+    if len(found_printers) == 0:
+        # Don't remember misses, the printer may not be switched on yet
+        _find_printers.cache_clear()
+    return list(found_printers)
+
+
+def refresh_printers():
+    _find_printers.cache_clear()
+
+
+class PrinterIOError(RuntimeError):
+    pass
+
+
+# Cached discovery hands the same device to several printer instances,
+# only release it once the last of them is gone
+_device_users = Counter()
 
 
 class BrotherPt:
-    def __init__(self, serial: str = None):
-        printers = find_printers(serial)
+    def __init__(self, serial: str = None, cache_status: bool = False, cache_printers: bool = False):
+        printers = find_printers(serial, cache_printers)
         if len(printers) == 0:
             raise RuntimeError("No supported driver found")
 
@@ -49,9 +79,28 @@ class BrotherPt:
         self._media_type = None
         self._tape_color = None
         self._text_color = None
+        self._cache_status = cache_status
+        self._status_cached = False
 
         self._dev = printers[0]
-        self.__initialize()
+        _device_users[self._dev] += 1
+        # Single worker keeps submitted transfers in order
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            self.__initialize()
+        except (usb.core.USBError, PrinterIOError):
+            if not cache_printers:
+                raise
+            # Cached device is stale if the printer was unplugged or switched off
+            refresh_printers()
+            printers = find_printers(serial, cache_printers)
+            if len(printers) == 0:
+                raise RuntimeError("No supported driver found")
+            self.__release_device()
+            self._dev = printers[0]
+            _device_users[self._dev] += 1
+            self.__initialize()
 
     def __initialize(self):
         # libusb initialization, and bypass kernel drivers
@@ -59,39 +108,122 @@ class BrotherPt:
             self._dev.detach_kernel_driver(0)
 
         self._dev.set_configuration()
+
+        # Fixed parts of the print job preamble, only the print information
+        # and margin in between depend on the job
+        self._preamble_head = enter_dynamic_command_mode() + enable_status_notification()
+        self._preamble_mode = set_mode() + set_advanced_mode()
+        self._preamble_tail = set_compression_mode()
+
         self.update_status()
 
     def __del__(self):
-        usb.util.dispose_resources(self._dev)
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        self.__release_device()
+
+    def __release_device(self):
+        _device_users[self._dev] -= 1
+        if _device_users[self._dev] <= 0:
+            del _device_users[self._dev]
+            usb.util.dispose_resources(self._dev)
 
     def __write(self, data: bytes) -> int:
+        # pyusb hands array('B') buffers to libusb as they are and copies
+        # anything else, so convert once and only slice when chunking
+        buffer = array.array('B', data)
+        length = 0
+        while length < len(buffer):
+            # chunk into bulk transfers, not packets
+            end = length + USB_MAX_TRANSFER_BYTES
+            chunk = buffer if length == 0 and end >= len(buffer) else buffer[length:end]
+            try:
+                written = self._dev.write(USB_OUT_EP_ID, chunk, USB_TRX_TIMEOUT_MS)
+            except usb.core.USBError as e:
+                self._status_cached = False
+                raise PrinterIOError("IO timeout while writing to printer")
+            if written == 0:
+                self._status_cached = False
+                raise PrinterIOError("IO timeout while writing to printer")
+            length += written
+        return length
+
+    def __write_stream(self, chunks) -> int:
+        # Keep up to USB_MAX_PENDING_TRANSFERS writes queued so the bus stays
+        # busy while the next chunk is being generated
+        pending = deque()
         length = 0
-        while length < len(data):
-            # chunk into packet size
-            length += self._dev.write(USB_OUT_EP_ID, data[length:(length+0x40)], USB_TRX_TIMEOUT_MS)
-            if length == 0:
-                raise RuntimeError("IO timeout while writing to printer")
+        failed = threading.Event()
+
+        def transfer(chunk):
+            # The worker may already be on the next chunk when a transfer
+            # fails, skip it rather than waiting for another timeout
+            if failed.is_set():
+                return 0
+            try:
+                return self.__write(chunk)
+            except Exception:
+                failed.set()
+                raise
+
+        try:
+            for chunk in chunks:
+                if len(pending) == USB_MAX_PENDING_TRANSFERS:
+                    length += pending.popleft().result()
+                pending.append(self._writer.submit(transfer, chunk))
+            while len(pending) > 0:
+                length += pending.popleft().result()
+        finally:
+            for transfer in pending:
+                transfer.cancel()
         return length
 
     def __read(self, length: int = 0x80) -> bytes:
         try:
             data = self._dev.read(USB_IN_EP_ID, length, USB_TRX_TIMEOUT_MS)
         except usb.core.USBError as e:
-            raise RuntimeError("IO timeout while reading from printer")
+            self._status_cached = False
+            raise PrinterIOError("IO timeout while reading from printer")
         return data
 
+    def __post_read(self, length: int = 0x80):
+        # Post the read before sending the command that triggers the
+        # response, so the transfer is already waiting when the printer replies
+        return self._reader.submit(self.__read, length)
+
+    def __request(self, data: bytes, length: int = 0x80):
+        response = self.__post_read(length)
+        try:
+            self.__write(data)
+        except Exception:
+            # Don't leave the posted read running without an owner, it would
+            # swallow a late reply and block the next read
+            try:
+                response.result()
+            except Exception:
+                pass
+            raise
+        return response
+
     def update_status(self):
+        # Media doesn't change between jobs unless the cassette is swapped
+        if self._cache_status and self._status_cached:
+            return
+        self.refresh_status()
+
+    def refresh_status(self):
+        self._status_cached = False
         self.__write(invalidate())
         self.__write(initialize())
         status_information = b''
         while len(status_information) == 0:
-            self.__write(status_information_request())
-            status_information = self.__read(STATUS_MESSAGE_LENGTH)
+            status_information = self.__request(status_information_request(), STATUS_MESSAGE_LENGTH).result()
 
         self._media_width = status_information[StatusOffsets.MEDIA_WIDTH]
         self._media_type = MediaType(status_information[StatusOffsets.MEDIA_TYPE])
         self._tape_color = TapeColor(status_information[StatusOffsets.TAPE_COLOR_INFORMATION])
         self._text_color = TextColor(status_information[StatusOffsets.TEXT_COLOR_INFORMATION])
+        self._status_cached = True
 
     @property
     def media_width(self) -> int:
@@ -110,66 +242,64 @@ class BrotherPt:
         return self._text_color
 
     def print_data(self, data:bytes, margin_px:int, is_last_page:bool=True):
-        self.__write(enter_dynamic_command_mode())
-        self.__write(enable_status_notification())
-        self.__write(print_information(data, self.media_width))
-        self.__write(set_mode())
-        self.__write(set_advanced_mode())
-        self.__write(margin_amount(margin_px))
-        self.__write(set_compression_mode())
-        for cmd in gen_raster_commands(data):
-            self.__write(cmd)
+        chunk_length = RASTER_LINES_PER_TRANSFER * LINE_LENGTH_BYTES
+        rasters = (data[i:i + chunk_length] for i in range(0, len(data), chunk_length))
+        self.print_rasters(rasters, len(data) // LINE_LENGTH_BYTES, margin_px, is_last_page)
+
+    def print_rasters(self, rasters, lines:int, margin_px:int, is_last_page:bool=True):
+        self.__write(b''.join([
+            self._preamble_head,
+            print_information_lines(lines, self.media_width),
+            self._preamble_mode,
+            margin_amount(margin_px),
+            self._preamble_tail,
+        ]))
 
         # Send 6 blank lines to ensure the printer finishes the print job
         # (This gets image aligned properly in P710BT)
-        for _ in range(6):
-            self.__write(b'\x5A')
+        trailer = b'\x5A' * 6
 
         if is_last_page:
-            self.__write(print_with_feeding())
+            trailer += print_with_feeding()
         else:
-            self.__write(print_without_feeding())
+            trailer += print_without_feeding()
+
+        # Raster chunks are generated while earlier ones are being transferred
+        self.__write_stream(b''.join(gen_raster_commands(raster)) for raster in rasters)
+
+        response = self.__request(trailer)
         while True:
-            res = self.__read()
+            res = response.result()
             if len(res) > 0:
                 if res[StatusOffsets.STATUS_TYPE] == StatusType.PRINTING_COMPLETED:
                     # absorb phase change message
                     self.__read()
                     break
                 elif res[StatusOffsets.STATUS_TYPE] == StatusType.ERROR_OCCURRED:
-                    error_message = ''
-                    if res[8]: # Error 1
-                        if res[8] & 0x01:
-                            error_message += 'no media|'
-                        if res[8] & 0x04:
-                            error_message += 'cutter jam|'
-                        if res[8] & 0x08:
-                            error_message += 'low batteries|'
-                        if res[8] & 0x40:
-                            error_message += 'high-voltage adapter|'
-                        pass
-                    if res[9]: # Error 2
-                        if res[9] & 0x01:
-                            error_message += 'wrong media (check size)|'
-                        if res[9] & 0x10:
-                            error_message += 'cover open|'
-                        if res[9] & 0x20:
-                            error_message += 'overheating|'
-                    if len(error_message) > 0:
-                        error_message = error_message[:-1]
-                    raise RuntimeError(error_message)
-
-    def print_images(self, images: list[Image], margin_px: int = 0):
+                    # Media may have been swapped or run out
+                    self._status_cached = False
+                    error_message = '|'.join(message for offset, mask, message in ERROR_MESSAGES
+                                             if res[offset] & mask)
+                    raise RuntimeError(error_message or 'unknown error')
+            response = self.__post_read()
+
+    def print_images(self, images: list[Image], margin_px: int = 0, cache: bool = False):
         self.update_status()
         pages_left = len(images)
         for image in images:
+            # Resolve the raster channel before any job bytes go out, so an
+            # unsupported image doesn't leave the printer mid-job
             image = prepare_image(image, self.media_width)
             if (image.width + margin_px) < MINIMUM_TAPE_POINTS:
                 warnings.warn("Image (%i) + cut margin (%i) is smaller than minimum tape width (%i) ... "
                               "cutting length will be extended" % (image.width, margin_px, MINIMUM_TAPE_POINTS))
-            data = raster_image(image, self.media_width)
             pages_left -= 1
-            self.print_data(data, margin_px, pages_left == 0)
+            if cache:
+                data = raster_and_pack_cached(image, self.media_width)
+                self.print_data(data, margin_px, pages_left == 0)
+            else:
+                self.print_rasters(gen_raster_chunks(image, self.media_width), image.width, margin_px,
+                                   pages_left == 0)
 
 
 if __name__ == '__main__':
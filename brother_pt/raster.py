@@ -13,8 +13,22 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import hashlib
+from collections import OrderedDict
+
 from PIL import Image
-from .cmd import MediaWidthToTapeMargin, PRINT_HEAD_PINS
+try:
+    import numpy as np
+except ImportError:
+    # Slower pure Python fallback is used for rastering
+    np = None
+from .cmd import MediaWidthToTapeMargin, PRINT_HEAD_PINS, RASTER_LINES_PER_TRANSFER
+
+RASTER_CACHE_SIZE = 32
+
+# Lookup tables for thresholding, applied by PIL without calling back into Python
+_THRESHOLD_TABLE_L = bytes([0xFF] * 0xFF + [0x00])
+_THRESHOLD_TABLE_RGB = bytes([0xFF] * 0x80 + [0x00] * 0x80)
 
 
 # FIXME: test
@@ -29,80 +43,163 @@ def make_fit(image: Image, media_width: int):
 
 
 def has_transparency(img):
-    if img.info.get("transparency", None) is not None:
-        return True
-    if img.mode == "P":
-        transparent = img.info.get("transparency", -1)
-        for _, index in img.getcolors():
-            if index == transparent:
+    if img.mode != "P":
+        return False
+    transparency = img.info.get("transparency", None)
+    if transparency is None:
+        return False
+
+    # Only scan the image if a transparent palette entry is actually used
+    for _, index in img.getcolors(maxcolors=256):
+        if isinstance(transparency, int):
+            if index == transparency:
                 return True
+        elif index < len(transparency) and transparency[index] < 0xFF:
+            return True
+    return False
 
 
-def select_raster_channel(image: Image):
+def resolve_palette(image: Image):
     # Special handling for paletized images
     if image.mode == 'P':
         if has_transparency(image):
-            image = image.convert('RGBA')
+            return image.convert('RGBA')
         else:
-            image = image.convert('RGB')
+            return image.convert('RGB')
+    return image
+
+
+def select_raster_channel(image: Image):
+    image = resolve_palette(image)
 
     if image.mode == '1':
         # BW
         return image
     elif image.mode == 'L':
         # Use white as indication for background
-        return image.point(lambda x: 0xFF if x < 0xFF else 0)
+        return image.point(_THRESHOLD_TABLE_L, '1')
     elif image.mode == 'RGB' or image.mode == 'RGBA':
         # Use white as indication for background
-        return image.convert('L').point(lambda x: 0xFF if x < 0x80 else 0)
+        return image.convert('L').point(_THRESHOLD_TABLE_RGB, '1')
     else:
         raise AttributeError("Unsupported color space for printing: "+image.mode)
 
 
 # FIXME: Test
-def compress_buffer(buffer: bytearray):
-    # Compress bytes to bit
-    bits = bytearray()
-    for i in range(0, len(buffer), 8):
-        byte = 0
+def compress_buffer(buffer: bytes):
+    # Compress bytes to bit (MSB first), zero-padded to a full byte
+    if np is None:
+        bits = bytearray()
+        for i in range(0, len(buffer), 8):
+            byte = 0
+            for j, value in enumerate(buffer[i:i + 8]):
+                if value > 0:
+                    byte |= (1 << (7 - j))
+            bits.append(byte)
+        return bytes(bits)
+
+    bits = np.frombuffer(buffer, dtype=np.uint8) != 0
+    return np.packbits(bits, bitorder='big').tobytes()
+
+
+def fit_image(image: Image, media_width: int):
+    fitted_image = make_fit(image, media_width)
+    # Image doesn't fit the tape width
+    if fitted_image is None:
+        # FIXME: provide option for scaling
+        expected_height = MediaWidthToTapeMargin.to_print_width(media_width)
+        raise AttributeError("At least one dimension needs to fit the tape width: %i vs (%i, %i)" %
+                             (expected_height, image.width, image.height))
+    return fitted_image
 
-        for j in range(0, 8):
-            value = buffer[i + j]
 
-            if value > 0:
-                byte |= (1 << (7 - j))
+def prepare_image(image: Image, media_width: int):
+    return select_raster_channel(fit_image(image, media_width))
 
-        bits.append(byte)
-    return bits
 
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for vectorized rastering, install brother_pt[fast]")
 
-def prepare_image(image: Image, media_width: int):
-    width, height = image.width, image.height
-    image = make_fit(image, media_width)
-    # Image doesn't fit the tape width
-    if image is None:
-        # FIXME: provide option for scaling
-        expected_height = MediaWidthToTapeMargin.to_print_width(media_width)
-        raise AttributeError("At least one dimension needs to fit the tape width: %i vs (%i, %i)" %
-                             (expected_height, width, height))
 
-    return select_raster_channel(image)
+def luminance(image: Image):
+    _require_numpy()
+    # Single C-level pixel dump instead of per-pixel access
+    if image.mode != 'L':
+        image = image.convert('L')
+    return np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(image.height, image.width)
 
 
-def raster_image(prepared_image: Image, media_width: int):
-    # Print buffer
-    buffer = bytearray()
+def pack_columns(mask: "np.ndarray", media_width: int):
+    _require_numpy()
+    margin = MediaWidthToTapeMargin.margin[media_width]
 
-    # Compose raster template
+    height, width = mask.shape
+
+    # One row per column (print head line), leading and trailing margin of
+    # print head stay zero
+    lines = np.zeros((width, height + 2 * margin), dtype=bool)
+    lines[:, margin:margin + height] = mask.T
+
+    return np.packbits(lines, axis=1, bitorder='big').tobytes()
+
+
+def _raster_image_fallback(prepared_image: Image, media_width: int):
+    margin = b'\x00' * MediaWidthToTapeMargin.margin[media_width]
+    # PixelAccess object, much cheaper to index than getpixel()
+    pixels = prepared_image.load()
+
+    buffer = bytearray()
     for column in range(prepared_image.width):
         # Leading margin of print head
-        buffer += b'\x00'*MediaWidthToTapeMargin.margin[media_width]
+        buffer += margin
 
         # printable raster
         for row in range(prepared_image.height):
-            buffer += b'\xFF' if prepared_image.getpixel((column, row)) else b'\00'
+            buffer += b'\xFF' if pixels[column, row] else b'\x00'
 
         # Trailing margin of print head
-        buffer += b'\x00' * MediaWidthToTapeMargin.margin[media_width]
+        buffer += margin
 
     return compress_buffer(buffer)
+
+
+def raster_image(prepared_image: Image, media_width: int):
+    if np is None:
+        return _raster_image_fallback(prepared_image, media_width)
+    pixels = luminance(prepared_image)
+    return pack_columns(pixels != 0, media_width)
+
+
+def raster_and_pack(image: Image, media_width: int):
+    # Threshold to a native 1-bit image in PIL, then transpose and pack
+    # without a per-pixel pass in Python
+    return raster_image(select_raster_channel(image), media_width)
+
+
+_raster_cache = OrderedDict()
+
+
+def raster_and_pack_cached(image: Image, media_width: int):
+    # Labels are often printed repeatedly, keyed on a digest of the pixel data
+    # so equal images hit the cache without keeping the source images alive
+    image = resolve_palette(image)
+    key = (hashlib.blake2b(image.tobytes()).digest(), image.mode, image.size, media_width)
+
+    data = _raster_cache.get(key)
+    if data is None:
+        data = raster_and_pack(image, media_width)
+        _raster_cache[key] = data
+        if len(_raster_cache) > RASTER_CACHE_SIZE:
+            _raster_cache.popitem(last=False)
+    else:
+        _raster_cache.move_to_end(key)
+    return data
+
+
+def gen_raster_chunks(image: Image, media_width: int, columns: int = RASTER_LINES_PER_TRANSFER):
+    # Raster a few columns at a time, so a long label is never held in memory as a whole
+    image = resolve_palette(image)
+    for column in range(0, image.width, columns):
+        chunk = image.crop((column, 0, min(column + columns, image.width), image.height))
+        yield raster_and_pack(chunk, media_width)
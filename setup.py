@@ -14,7 +14,7 @@
    limitations under the License.
 """
 
-from distutils.core import setup
+from setuptools import setup
 from brother_pt import VERSION
 
 setup(name='brother_pt',
@@ -29,5 +29,9 @@ setup(name='brother_pt',
           'Pillow==8.4.0',
           'packbits==0.6',
       ],
+      extras_require={
+          # Vectorized rastering, a pure Python fallback is used without it
+          'fast': ['numpy>=1.17'],
+      },
      )
 